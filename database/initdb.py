@@ -1,111 +1,53 @@
 """A script to initialize the MyAnimeList database"""
 import os
+import sys
 import time
 import psycopg2
 from glob import glob
+from functools import lru_cache
 from loguru import logger
 from dotenv import dotenv_values
 from psycopg2.errors import DatabaseError, OperationalError, ProgrammingError
 
+# The initialization scripts, in the order that they need to run
+INIT_SCRIPTS = (
+    "create_schemas.sql",
+    "table/stage/*.sql",
+    "table/prod/*.sql",
+    "view/*.sql",
+)
 
-def create_schemas(connection: psycopg2.extensions.connection) -> None:
+@lru_cache(maxsize=None)
+def read_scripts(pattern: str) -> str:
     """
-    Runs the script to create the `anime` and  `anime_stage` schemas.
-    The script also enables the use of the `crosstab` function.
-    """
-    logger.info("Creating schemas...")
-    try:
-        with open("create_schemas.sql", "r", encoding="utf-8") as query:
-            query = query.read()
-            try:
-                with connection.cursor() as cursor:
-                    cursor.execute(query)
-                logger.info("Schemas created successfully!")
-            except (DatabaseError, OperationalError):
-                logger.exception("Issue occurred while creating schemas:\n")
-                raise
-    except FileNotFoundError:
-        logger.exception(
-            "Cannot find the `create_schemas.sql` file. Is it in this directory?"
-        )
-        raise
+    Reads every script matching the given pattern and joins them into a
+    single multi-statement query. Results are cached, so each script is
+    only read from disk once per process.
 
-
-def create_staging(connection: psycopg2.extensions.connection) -> None:
-    """
-    Runs the script to create the `anime_stage` schema tables.
+    :param pattern: A glob pattern for the scripts to read
     """
-    stage_scripts = glob(os.path.normpath("table/stage/*.sql"))
-    # Open a connection, loop through each script, and execute it
-    logger.info("Creating staging...")
-    try:
-        with connection.cursor() as cursor:
-            for script in stage_scripts:
-                # Open the script
-                with open(script, "r", encoding="utf-8") as query:
-                    query = query.read()
-                    try:
-                        cursor.execute(query)
-                    except (DatabaseError, OperationalError):
-                        logger.exception(
-                            f"Error occurred while running script:\n{query}\n"
-                        )
-                        raise
-        logger.info("Staging created successfully!")
-    except (DatabaseError, OperationalError):
-        logger.exception("Error connecting to database")
-        raise
+    queries = []
+    for script in sorted(glob(os.path.normpath(pattern))):
+        with open(script, "r", encoding="utf-8") as query:
+            queries.append(query.read().strip().rstrip(";") + ";")
+    return "\n".join(queries)
 
 
-def create_production(connection: psycopg2.extensions.connection) -> None:
-    """
-    Runs the script to create the `anime` schema tables.
+def run_scripts(connection: psycopg2.extensions.connection, *patterns: str) -> None:
     """
-    prod_scripts = glob(os.path.normpath("table/prod/*.sql"))
-    # Open a connection, loop through each script, and execute it
-    logger.info("Creating production...")
-    try:
-        with connection.cursor() as cursor:
-            for script in prod_scripts:
-                # Open the script
-                with open(script, "r", encoding="utf-8") as query:
-                    query = query.read()
-                    try:
-                        cursor.execute(query)
-                    except (DatabaseError, OperationalError):
-                        logger.exception(
-                            f"Error occurred while running script:\n{query}"
-                        )
-                        raise
-            logger.info("Production created successfully!")
-    except (DatabaseError, OperationalError):
-        logger.exception("Error connecting to database")
-        raise
-
+    Runs every script matching the given patterns in a single round-trip.
+    Scripts are run in the order that their patterns are given.
 
-def initialize_views(connection: psycopg2.extensions.connection) -> None:
-    """
-    Runs the script to create predefined materialized views.
+    :param connection: An open connection to the database
+    :param patterns: Glob patterns for the scripts to run
     """
-    view_scripts = glob(os.path.normpath("view/*.sql"))
-    logger.info("Initializing views...")
-    try:
-        with connection.cursor() as cursor:
-            for script in view_scripts:
-                # Open the script
-                with open(script, "r", encoding="utf-8") as query:
-                    query = query.read()
-                    try:
-                        cursor.execute(query)
-                    except (DatabaseError, OperationalError):
-                        logger.exception(
-                            f"Error occurred while running script:\n{query}"
-                        )
-                        raise
-            logger.info("Views created successfully!")
-    except (DatabaseError, OperationalError):
-        logger.exception("Error connecting to database")
-        raise
+    query = "\n".join(read_scripts(pattern) for pattern in patterns)
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(query)
+        except (DatabaseError, OperationalError):
+            logger.exception("Error occurred while running script:\n{}\n", query)
+            raise
 
 
 def initdb(config: dict) -> None:
@@ -117,22 +59,52 @@ def initdb(config: dict) -> None:
     """
     logger.info("Initializing database...")
     try:
+        if not os.path.exists("create_schemas.sql"):
+            logger.error(
+                "Cannot find the `create_schemas.sql` file. Is it in this directory?"
+            )
+            raise FileNotFoundError("create_schemas.sql")
         with psycopg2.connect(**config) as connection:
-            create_schemas(connection)
-            create_staging(connection)
-            create_production(connection)
-            initialize_views(connection)
+            # Send all of the DDL at once rather than waiting on the
+            # server between each phase
+            run_scripts(connection, *INIT_SCRIPTS)
         logger.info("Database initialization complete!")
     except (ProgrammingError, DatabaseError, OperationalError):
         logger.exception("Error connecting to the database:\n")
         raise
 
 
+def migrate_views(config: dict) -> None:
+    """
+    Drops and recreates the materialized views of an existing database
+    from the `view` scripts, leaving the tables and their data in place.
+    Run this after a view definition changes. It is needed once on any
+    database created before `anime.anime_stats_and_scores` became unique
+    on (anime_id, load_date), which `REFRESH ... CONCURRENTLY` requires.
+    """
+    logger.info("Rebuilding materialized views...")
+    try:
+        with psycopg2.connect(**config) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DROP MATERIALIZED VIEW IF EXISTS anime.anime_stats_and_scores;"
+                )
+            run_scripts(connection, "view/*.sql")
+        logger.info("Materialized views rebuilt!")
+    except (ProgrammingError, DatabaseError, OperationalError):
+        logger.exception("Error connecting to the database:\n")
+        raise
+
+
 if __name__ == "__main__":
     # Initialize configuration
     dbconfig = dotenv_values("dbenv")
     start = time.time()
-    initdb(dbconfig)
+    # `python initdb.py migrate` updates the views of an existing database
+    if sys.argv[1:] == ["migrate"]:
+        migrate_views(dbconfig)
+    else:
+        initdb(dbconfig)
     end = time.time()
     duration = round(end - start, 2)
     logger.info(f"Total duration: {duration} second(s)")
@@ -1,4 +1,4 @@
-CREATE TABLE IF NOT EXISTS anime_stage.all_anime
+CREATE UNLOGGED TABLE IF NOT EXISTS anime_stage.all_anime
 (
     id bigint,
     title text COLLATE pg_catalog."default",
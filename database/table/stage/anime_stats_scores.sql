@@ -1,4 +1,4 @@
-CREATE TABLE IF NOT EXISTS anime_stage.anime_stats_scores
+CREATE UNLOGGED TABLE IF NOT EXISTS anime_stage.anime_stats_scores
 (
     anime_id bigint,
     scores jsonb,
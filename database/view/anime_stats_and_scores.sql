@@ -30,7 +30,8 @@ AS
 			FROM anime.anime_scores
 		'::text) c(anime_id bigint, load_date date, "1" integer, "2" integer, "3" integer, "4" integer, "5" integer, "6" integer, "7" integer, "8" integer, "9" integer, "10" integer)
         )
- SELECT scores.anime_id,
+ SELECT DISTINCT ON (scores.anime_id, scores.load_date)
+    scores.anime_id,
     anime.title AS anime_title,
     stats.watching,
     stats.completed,
@@ -54,10 +55,16 @@ AS
             all_anime.title
            FROM anime.all_anime) anime ON scores.anime_id = anime.id
      JOIN anime.anime_stats stats ON scores.anime_id = stats.anime_id AND scores.load_date = stats.load_date::date
+  -- One row per anime per day: the last stats loaded that day, and the
+  -- first title when an anime is listed under more than one airing status.
+  -- Before the view was unique, a day with several stats loads, or an
+  -- anime with several titles, returned one row for each combination.
+  ORDER BY scores.anime_id, scores.load_date, stats.load_date DESC, anime.title
 WITH DATA;
 
 
-CREATE INDEX idx_anime_stats
+-- Unique so that the view can be refreshed concurrently
+CREATE UNIQUE INDEX idx_anime_stats
     ON anime.anime_stats_and_scores USING btree
     (anime_id, load_date)
     TABLESPACE pg_default;
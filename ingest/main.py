@@ -4,7 +4,6 @@ API and loading it to cloud storage. This is a long-running
 batch process that updates all of the anime data along
 with the latest statistics for each anime.
 """
-import os
 import sys
 import time
 import yaml
@@ -12,49 +11,28 @@ from yaml.loader import SafeLoader
 from dotenv import dotenv_values
 from loguru import logger
 from tqdm import tqdm
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from utils import anime, animestats, storage
-
-def command_validator(commands: list) -> int:
-    """
-    Takes in a list of commands from stdin and
-    determines whether or not to perform a test
-    run
-
-    :param commands: A list of commands from stdinput
-    """
-    page_count = None
-    command_str = " ".join(commands)
-    # Handle trial runs
-    if len(commands) == 3:
-        tests = [
-            commands[0] == "sample",
-            commands[1] == "-n",
-            commands[2].isnumeric(),
-        ]
-        valid_cmd = all(tests)
-        if not valid_cmd:
-            logger.info(
-                f"{command_str} was an invalid command."
-                "Continuing with default settings..."
-            )
-        else:
-            page_count = int(commands[2])
-            logger.info(
-                f"Performing test run using a sample size of {page_count * 25} anime"
-            )
-
-    return page_count
+from utils.commands import command_validator
 
 
 def main():
     logger.info("Initializing...")
     start = time.time()
+    # Both data sets are written to the partition of the day the run started,
+    # which is where the transform job reads them from together
+    partition_date = datetime.now()
     with open('utils/config.yaml', 'r', encoding='utf-8') as f:
         data_config = yaml.load(f, Loader=SafeLoader)
     config = dotenv_values('.env')
     commands = sys.argv[1:]
     # Determine the number of pages to collect from the anime endpoint
     page_count = command_validator(commands)
+    if page_count is not None:
+        logger.info(
+            f"Performing test run using a sample size of {page_count * 25} anime"
+        )
     testing = True if page_count is not None else False
     sample = page_count * 25 if page_count is not None else 0
     # Start a connection to the storage client
@@ -62,20 +40,43 @@ def main():
     bucket = "myanimelist"
     # Run each process in order and display a progress bar
     logger.info("Starting ingestion...")
-    for process in tqdm(range(2)):
-        if process == 0:
-            # Upload anime info 
-            logger.info("Uploading anime info...")
-            err, input_file = anime.upload_all_anime(client, data_config['schema'], page_count)
-            if err is not None:
-                logger.info(f"Error occurred while uploading anime info {repr(err)}")
-                os._exit(1)
-            logger.info("Anime info has been uploaded to storage!")
-        elif process == 1:
-            # Upload anime stats
-            logger.info("Uploading anime stats...")
-            animestats.upload_anime_stats(client, bucket, input_file, testing=testing, sample=sample)
-            logger.info("Anime stats uploaded!")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for process in tqdm(range(2)):
+            if process == 0:
+                # Upload anime info in the background
+                logger.info("Uploading anime info...")
+                err, anime_data, upload = anime.upload_all_anime(
+                    client, data_config['schema'], executor, page_count, partition_date
+                )
+                if err is not None:
+                    logger.info(f"Error occurred while uploading anime info {repr(err)}")
+                    sys.exit(1)
+            elif process == 1:
+                # Don't start the stats if the anime info write has already failed
+                if upload.done() and upload.exception() is not None:
+                    logger.info(
+                        f"Error occurred while uploading anime info {repr(upload.exception())}"
+                    )
+                    sys.exit(1)
+                # Upload anime stats using the anime info already in memory
+                logger.info("Uploading anime stats...")
+                animestats.upload_anime_stats(
+                    client,
+                    bucket,
+                    input_file=None,
+                    partition_date=partition_date,
+                    testing=testing,
+                    sample=sample,
+                    anime_data=anime_data,
+                )
+                logger.info("Anime stats uploaded!")
+        # Make sure the anime info has finished writing before exiting
+        try:
+            upload.result()
+        except Exception as err:
+            logger.info(f"Error occurred while uploading anime info {repr(err)}")
+            sys.exit(1)
+        logger.info("Anime info has been uploaded to storage!")
     
     logger.info("Ingestion complete!")
     end = time.time()
@@ -8,104 +8,167 @@ from MyAnimeList using the Jikkan API.
 The Jikkan API documentation can be found here:
 https://docs.api.jikan.moe/
 """
-import os
 import sys
 import boto3
-import json
 import time
+import orjson
 import yaml
 import asyncio
 import aiohttp
-import requests
 import utils.storage as storage
+from utils.commands import command_validator
+from utils.http import create_session, discard, is_cached
+from utils.ratelimit import RateLimiter, retry_after
 from loguru import logger
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import dotenv_values
 from yaml.loader import SafeLoader
 
+_EMPTY = {}
 
-def get_page_count() -> tuple:
+
+async def get_page_count(session: aiohttp.ClientSession) -> tuple:
     """
-    Gets the total page count for the `all anime` endpoint.
+    Gets the total page count for the `all anime` endpoint using the
+    given session, so the call reuses its pooled connections.
     Returns a tuple with the structure (status code, value).
+
+    :param session: A session used to call the API
     """
     URL = "https://api.jikan.moe/v4/anime?sfw=true"
-    response = requests.get(URL)
-    status = response.status_code
-    if status == 200:
-        total_pages = json.loads(response.content)
-        return (status, int(total_pages["pagination"]["last_visible_page"]))
-    return (status, 0)
+    async with session.get(URL) as response:
+        status = response.status
+        if status == 200:
+            total_pages = orjson.loads(await response.read())
+            return (status, int(total_pages["pagination"]["last_visible_page"]))
+        return (status, 0)
 
 
-async def get_anime_page(session, url) -> tuple:
+async def get_anime_page(
+    session: aiohttp.ClientSession,
+    url: str,
+    semaphore: asyncio.Semaphore,
+    limiter: RateLimiter,
+    max_retries: int = 5,
+) -> tuple:
     """
     Gets the anime page specified in the given `url`.
     Returns a tuple of (status code, response). In the
     case of an error status, the response returned is the URL
-    that returned the error.
+    that returned the error. Rate limited responses (429) are
+    retried up to `max_retries` times, pausing the limiter for
+    as long as the `Retry-After` header asks, or exponentially
+    longer on each attempt if it is missing.
 
     :param session: A session used to call the API
     :param url: The URL for the API call
+    :param semaphore: Caps the number of requests in flight at once
+    :param limiter: A rate limiter used to stay within the API rate limit
+    :param max_retries: The number of times to retry a rate limited request
     """
-    async with session.get(url) as response:
-        status = response.status
-        if status == 200:
-            page = await response.json()
-            return (status, page)
-        return (status, url)
+    for attempt in range(max_retries + 1):
+        async with semaphore:
+            if not await is_cached(session, url):
+                await limiter.acquire()
+            async with session.get(url) as response:
+                status = response.status
+                if status == 200:
+                    page = orjson.loads(await response.read())
+                    return (status, page)
+                await discard(response)
+                if status != 429:
+                    return (status, url)
+                delay = retry_after(response.headers, min(30, 2 ** attempt))
+        limiter.backoff(delay)
+    logger.warning(f"Giving up on {url} after {max_retries} retries")
+    return (status, url)
 
 
-async def generate_anime_list(session: aiohttp.ClientSession, page_count: int = 0):
+async def generate_anime_list(
+    session: aiohttp.ClientSession,
+    queue: asyncio.Queue,
+    page_count: int = 0,
+    concurrency: int = 3,
+    per_second: int = 3,
+    per_minute: int = 60,
+):
     """
-    Returns a list containing pages from the all anime list
+    Puts each page from the all anime list on the given queue as soon as
+    it has been downloaded
 
     :param session: A session used to call the API
+    :param queue: The queue that downloaded pages are put on
     :param page_count: The number of pages to extract from the endpoint.
                        If this is not passed, it will extract all current
                        pages. Each page contains information for 25 anime
                        titles.
+    :param concurrency: The maximum number of requests in flight at once
+    :param per_second: The maximum number of requests sent per second
+    :param per_minute: The maximum number of requests sent per minute
     """
     urls = [
         f"https://api.jikan.moe/v4/anime?page={page}&sfw=true" 
         for page in range(1, page_count+1)
     ]
-    pages = []
-    while len(urls) > 0:
-        tasks = []
-        # Process anime's asynchronously, continuously decreasing
-        # batch size (based on sleep time) to achieve ~20-33% boost in 
-        # total processing speed compared to waiting 1 second between
-        # calls to account for rate limiting.
-        for url in urls:
-            task = asyncio.ensure_future(get_anime_page(session, url))
-            tasks.append(task)
-            await asyncio.sleep(1/2)
-        results = await asyncio.gather(*tasks)
-        # Check status codes and assign results to appropriate list
-        pages += [res[1] for res in results if res[0] == 200]
-        retries = [res[1] for res in results if res[0] == 429]
-        # Retry URLs returned with timeout status code (429)
-        urls = retries
-        results = None
-        
-    return pages
-
-
-async def get_anime(page_count: int = None):
+    # Requests are issued concurrently, bounded by the semaphore and
+    # paced by the rate limiter to respect the Jikkan rate limit
+    # (3 requests per second and 60 requests per minute). Each request
+    # handles its own retries, so a single pass covers every page.
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(per_second=per_second, per_minute=per_minute)
+
+    async def fetch(url):
+        status, result = await get_anime_page(session, url, semaphore, limiter)
+        if status == 200:
+            await queue.put(result)
+
+    await asyncio.gather(*(fetch(url) for url in urls))
+
+
+async def extractor(queue: asyncio.Queue, schema: list, anime_data: list):
     """
-    Gets all the raw anime data from the Jikan API /anime endpoint
+    Extracts the anime data from each page put on the queue and adds it
+    to `anime_data`, until a `None` sentinel is received.
 
+    :param queue: The queue that downloaded pages are put on
+    :param schema: The schema to use to extract anime data from the raw data.
+    :param anime_data: The list that collects the extracted anime data
+    """
+    while True:
+        page = await queue.get()
+        if page is None:
+            break
+        anime_data += extract_anime_data([page], schema)
+
+
+async def get_anime(schema: list, page_count: int = None) -> list:
+    """
+    Gets all the anime data from the Jikan API /anime endpoint. Each page
+    is extracted using the given schema while the rest are still being
+    downloaded, so extraction overlaps with the API calls.
+
+    :param schema: The schema to use to extract anime data from the raw data.
     :param page_count: The number of pages to extract from the endpoint.
                        If this is not passed, it will extract all current
                        pages. Each page contains information for 25 anime
                        titles.
     """
-    async with aiohttp.ClientSession() as session:
-        if page_count is None:
-            page_count = get_page_count()
-        pages = await generate_anime_list(session, page_count)
-    return pages
+    queue = asyncio.Queue()
+    anime_data = []
+    consumer = asyncio.create_task(extractor(queue, schema, anime_data))
+    try:
+        async with create_session() as session:
+            if page_count is None:
+                status, page_count = await get_page_count(session)
+                if status != 200:
+                    raise ValueError("Error retrieving page count from API")
+            await generate_anime_list(session, queue, page_count)
+    finally:
+        # Let the extractor finish the pages already on the queue
+        await queue.put(None)
+        await consumer
+    return anime_data
 
 
 def extract_anime_data(raw_data: list, schema: list) -> dict:
@@ -117,14 +180,17 @@ def extract_anime_data(raw_data: list, schema: list) -> dict:
     :param schema: The schema to use to extract anime data from the raw data.
     """
     anime_data = []
+    # The nested `aired` field is flattened into `aired_from` and `aired_to`.
+    # Looping over the handful of schema fields rather than every key in
+    # the anime record keeps the number of lookups per anime small.
+    fields = tuple(field for field in schema if field != "aired")
     try:
         for page in raw_data:
             for anime in page["data"]:
-                cols = [field for field in anime.keys() if field in schema]
-                data = {col: anime[col] for col in cols}
-                data["aired_from"] = data["aired"]["from"]
-                data["aired_to"] = data["aired"]["to"]
-                data.pop("aired")
+                data = {k: anime[k] for k in fields if k in anime}
+                aired = anime.get("aired") or _EMPTY
+                data["aired_from"] = aired.get("from")
+                data["aired_to"] = aired.get("to")
                 anime_data.append(data)
     except KeyError:
         logger.exception(
@@ -138,46 +204,46 @@ def extract_anime_data(raw_data: list, schema: list) -> dict:
 def upload_all_anime(
     client: boto3.client, 
     schema: list, 
+    executor: ThreadPoolExecutor,
     page_count: int = None, 
-    partition_date: datetime = datetime.now()
+    partition_date: datetime = None
     ) -> tuple:
     """
     Extracts anime data from the Jikkan all anime enpoint
-    and writes it to cloud storage.
+    and writes it to cloud storage. The write is done in the
+    background on the given executor so that the extracted data can
+    be used right away. Returns a tuple of (error, data, upload) where
+    `upload` is a future that resolves to the path written to storage.
 
     :param client: A boto3 client configured to access s3 storage
     :param schema: The schema to use to extract anime data from the raw data.
+    :param executor: The executor used to write to storage in the background
     :param page_count: The number of pages to extract from the endpoint.
                        If this is not passed, it will extract all current
                        pages. Each page contains information for 25 anime
                        titles.
+    :param partition_date: The partition date to write. Defaults to now.
     """
+    partition_date = partition_date or datetime.now()
     try:
-        if page_count is None:
-            status, page_count = get_page_count()
-            if status != 200:
-                raise ValueError("Error retrieving page count from API")
-        logger.info("Connecting to Jikkan API and extracting raw data...")
-        # Get the raw data
-        raw_data = asyncio.run(get_anime(page_count))
-        # Extract the data we want
-        logger.info("Raw extraction complete! Extracting configured fields...")
-        data = extract_anime_data(raw_data, schema)
-        logger.info("Extraction complete! Writing to storage...")
+        logger.info("Connecting to Jikkan API and extracting anime data...")
+        # Get the data we want, extracting each page as it arrives
+        data = asyncio.run(get_anime(schema, page_count))
+        logger.info("Extraction complete! Writing to storage in the background...")
         # Write to storage
         prefix = "all_anime/raw"
-        filename = "all_anime.json"
-        file_partition = storage.write_to_storage(
+        filename = "all_anime.ndjson.gz"
+        upload = executor.submit(
+            storage.write_ndjson_to_storage,
             client=client, 
-            obj=data, 
+            rows=data, 
             prefix=prefix, 
             filename=filename,
             partition_date=partition_date
         )
-        logger.info("Writing to storage is complete!")
-        return (None, file_partition)
+        return (None, data, upload)
     except Exception as ex:
-        return (ex, None)
+        return (ex, None, None)
 
 
 def main():
@@ -186,30 +252,22 @@ def main():
         config = yaml.load(f, Loader=SafeLoader)
     dbconfig = dotenv_values(".env")
     # Check for commandline arguments
-    page_count = None
-    commands = sys.argv[1:]
-    command_str = " ".join(commands)
-    if len(commands) == 3:
-        tests = [
-            commands[0] == "sample",
-            commands[1] == "-n",
-            commands[2].isnumeric(),
-        ]
-        valid_cmd = all(tests)
-        if not valid_cmd:
-            logger.info(
-                f"{command_str} was an invalid command."
-                "Continuing with default settings..."
-            )
-        else:
-            page_count = int(commands[2])
+    page_count = command_validator(sys.argv[1:])
     logger.info("Starting process...")
     start = time.time()
     client = storage.access_storage(dbconfig)
-    err, filename = upload_all_anime(client, config["schema"], page_count)
-    if err is not None:
-        logger.info(f"An error occurred while getting anime info:\n{repr(err)}")
-        os._exit(1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        err, _, upload = upload_all_anime(
+            client, config["schema"], executor, page_count
+        )
+        if err is not None:
+            logger.info(f"An error occurred while getting anime info:\n{repr(err)}")
+            sys.exit(1)
+        try:
+            filename = upload.result()
+        except Exception as err:
+            logger.info(f"An error occurred while writing anime info:\n{repr(err)}")
+            sys.exit(1)
     logger.info(f"Process complete! Anime data has been written to {filename}")
     end = time.time()
     duration = round(end - start, 2)
@@ -8,73 +8,165 @@ from MyAnimeList using the Jikkan API.
 The Jikkan API documentation can be found here:
 https://docs.api.jikan.moe/
 """
-import os
 import sys
 import time
+import itertools
 import boto3
+import random
+import orjson
 import asyncio
 import aiohttp
 import utils.storage as storage
+from utils.commands import command_validator
+from utils.http import create_session, discard, is_cached
+from utils.ratelimit import RateLimiter, retry_after
 from botocore.exceptions import ClientError, EndpointConnectionError
 from dotenv import dotenv_values
 from loguru import logger
+from operator import itemgetter
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
 
-async def get_stats(session: aiohttp.ClientSession, url: str, anime_id: int):
+async def get_stats(
+    session: aiohttp.ClientSession,
+    url: str,
+    anime_id: int,
+    limiter: RateLimiter = None,
+):
     """
     A worker function that obtains the anime stats from the endpoint
     and returns the JSON response if found. Otherwise, it returns the
-    status code from the response.
+    status code from the response. When a limiter is given, a rate
+    limited response (429) pauses it for as long as the `Retry-After`
+    header asks.
 
     :param session: An asynchronous client session to connect to the endpoint
     :param url: The API endpoint to call
     :param anime_id: The `mal_id` used for the API request
+    :param limiter: The rate limiter shared by the workers calling the API
     """
     async with session.get(url) as response:
         status = response.status
         if status == 200:
-            stats = await response.json()
+            stats = await response.json(loads=orjson.loads)
             # Append the anime_id to result
             stats["mal_id"] = anime_id
             return (status, stats)
         # We didn't get data - return the status
+        await discard(response)
+        if status == 429 and limiter is not None:
+            limiter.backoff(retry_after(response.headers, 1))
         return (status, anime_id)
 
 
-async def get_anime_stats(anime_ids: list):
+async def stats_worker(
+    session: aiohttp.ClientSession,
+    queue: asyncio.Queue,
+    limiter: RateLimiter,
+    store,
+    failed: list,
+    attempts: dict,
+    max_retries: int = 5,
+):
+    """
+    Pulls anime IDs off the queue and fetches their stats until cancelled.
+    Successful responses are passed to `store` as they arrive. Rate limited IDs
+    (429) are put back on the queue after an exponential back-off with
+    jitter, and are added to `failed` once they have used up their retries.
+
+    :param session: An asynchronous client session to connect to the endpoint
+    :param queue: A queue of `mal_id`s waiting to be processed
+    :param limiter: A rate limiter shared by all workers to pace requests
+    :param store: A callable that takes each successful result
+    :param failed: The list that collects the IDs that could not be fetched
+    :param attempts: The number of retries made so far for each ID
+    :param max_retries: The number of times to retry a rate limited ID
+    """
+    while True:
+        anime_id = await queue.get()
+        try:
+            url = f"https://api.jikan.moe/v4/anime/{anime_id}/statistics"
+            # Cached stats never reach the API, so they are not rate limited
+            cached = await is_cached(session, url)
+            if not cached:
+                await limiter.acquire()
+            status, result = await get_stats(session, url, anime_id, limiter)
+            if not cached:
+                limiter.record(status == 429)
+            if status == 200:
+                store(result)
+            elif status == 429:
+                attempt = attempts.get(anime_id, 0) + 1
+                attempts[anime_id] = attempt
+                if attempt > max_retries:
+                    failed.append(anime_id)
+                else:
+                    await asyncio.sleep(min(30, 2 ** attempt + random.random() / 2))
+                    queue.put_nowait(anime_id)
+        finally:
+            queue.task_done()
+
+
+async def get_anime_stats(
+    anime_ids: list,
+    concurrency: int = 3,
+    per_second: int = 3,
+    per_minute: int = 60,
+    expire_after: int = 86400,
+    store=None,
+):
     """
     Gets the anime stats from the Jikkan API statistics endpoint.
     Statistics are gathered on a per-anime basis. To access statistics,
-    the endpoint requires a valid `mal_id` from the client.
+    the endpoint requires a valid `mal_id` from the client. Returns a
+    tuple of (anime stats, IDs that could not be fetched). Duplicate IDs
+    are fetched once, and responses are cached so that a re-run within
+    `expire_after` seconds skips the IDs that were already fetched.
+
+    When `store` is given, each result is handed to it as soon as it
+    arrives instead of being collected, and the returned stats are empty.
 
     :param anime_id: A list of valid anime IDs (mal_id)
+    :param concurrency: The number of workers fetching stats at once
+    :param per_second: The maximum number of requests sent per second
+    :param per_minute: The maximum number of requests sent per minute
+    :param expire_after: The number of seconds that cached stats stay valid
+    :param store: A callable that takes each result, such as a storage writer
     """
     anime_stats = []
-    to_process = anime_ids
-    total_anime = len(anime_ids)
-    while len(anime_stats) < total_anime:
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            # Process anime id's asynchronously, continuously decreasing
-            # batch size (based on sleep time) to achieve ~20-33% boost in 
-            # total processing speed compared to waiting 1 second between
-            # calls to account for rate limiting.
-            for id in to_process:
-                url = f"https://api.jikan.moe/v4/anime/{id}/statistics"
-                task = asyncio.ensure_future(get_stats(session, url, id))
-                tasks.append(task)
-                await asyncio.sleep(1/2)
-            results = await asyncio.gather(*tasks)
-            # Extract good data from bad in response
-            success = [res[1] for res in results if res[0] == 200]
-            retries = [res[1] for res in results if res[0] == 429]
-            anime_stats += success
-            total_anime = len(anime_stats) + len(retries)
-            to_process = retries
-
-    return anime_stats
+    if store is None:
+        store = anime_stats.append
+    failed = []
+    attempts = {}
+    queue = asyncio.Queue()
+    for anime_id in dict.fromkeys(anime_ids):
+        queue.put_nowait(anime_id)
+    # A fixed pool of workers drains the queue, so retries are picked up
+    # as soon as a worker is free instead of waiting for the whole batch
+    limiter = RateLimiter(per_second=per_second, per_minute=per_minute)
+    async with create_session(
+        limit=concurrency, expire_after=expire_after
+    ) as session:
+        workers = [
+            asyncio.create_task(
+                stats_worker(session, queue, limiter, store, failed, attempts)
+            )
+            for _ in range(concurrency)
+        ]
+        finished = asyncio.create_task(queue.join())
+        await asyncio.wait([finished, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for task in [finished, *workers]:
+            task.cancel()
+        results = await asyncio.gather(finished, *workers, return_exceptions=True)
+        # Surface any error raised inside one of the workers
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    return (anime_stats, failed)
 
 
 def extract_anime_ids(anime_data: list) -> list:
@@ -84,7 +176,7 @@ def extract_anime_ids(anime_data: list) -> list:
     :param anime_data: The raw all_anime data in a list
     """
     try:
-        anime_ids = (anime["mal_id"] for anime in anime_data)
+        anime_ids = map(itemgetter("mal_id"), anime_data)
         return anime_ids
     except KeyError:
         logger.exception("There was an error extracting the anime IDs. Check code.")
@@ -93,14 +185,15 @@ def extract_anime_ids(anime_data: list) -> list:
 
 def get_anime_data(client: boto3.client, bucketname: str, filename: str) -> tuple:
     """
-    Gets the anime data from storage and returns a tuple with the data and a success status
+    Gets the anime data from storage and returns a tuple with the data and a success status.
+    The data is streamed from storage as it is consumed, so it can only be iterated once.
 
     :param client: A boto3 client configured to access storage
     :param bucketname: The name of the bucket where MyAnimeList data is stored
-    :param filename: The filename and partition path of the all_anime.json file
+    :param filename: The filename and partition path of the all_anime.ndjson.gz file
     """
     try:
-        anime_data = storage.read_from_storage(client, bucketname, filename)
+        anime_data = storage.stream_from_storage(client, bucketname, filename)
         return (None, anime_data)
     except (ClientError, EndpointConnectionError) as ex:
         return (ex, None)
@@ -110,56 +203,85 @@ def upload_anime_stats(
     client: boto3.client,
     bucketname: str,
     input_file: str,
-    output_file: str = "anime_stats.json",
+    output_file: str = "anime_stats.ndjson.gz",
     prefix: str = "anime_stats/raw",
-    partition_date: datetime = datetime.now(),
+    partition_date: datetime = None,
     testing: bool = False,
     sample: int = 0,
+    anime_data: list = None,
 ) -> tuple:
     """
     Extracts anime stats from the Jikkan API statistics endpoint
     and uploads them to cloud storage. Returns an error status and
-    the total number of anime stats uploaded.
+    the total number of anime stats uploaded. The stats are streamed to
+    storage as gzip compressed NDJSON while they are extracted, rather
+    than held in memory until the extraction is finished.
 
     :param client:  A boto3 client configured to access storage
     :param bucketname: The name of the bucket where MyAnimeList data is stored
-    :param input_file: The location of the `all_anime.json` data for `mal_id` extraction
-    :param output_file: The path that the `anime_stats.json` data will be written to
+    :param input_file: The location of the `all_anime.ndjson.gz` data for `mal_id` extraction
+    :param output_file: The filename that the `anime_stats.ndjson.gz` data will be written to
     :param prefix: The prefix to use for the data set. Default is `anime_stats/raw`
+    :param partition_date: The partition date to write. Defaults to now.
     :param testing: A flag used to determine if this is a test run or not. If it is a test
                     run, then the `anime_id` list will be shortened up to the @sample size
     :param sample: An integer used to determine the number of anime_id's to use for testing
+    :param anime_data: The all_anime data, if it is already in memory. When this is passed
+                       the data is not read back from @input_file
     """
     # Get the anime ids
     logger.info("Getting Anime IDs...")
     try:
-        err, anime_data = get_anime_data(client, bucketname, input_file)
-        
-        if err is not None:
-            logger.info(f"There was an error with downloading the all_anime data\n{err}")
-            raise ValueError("Unable to continue without anime data")
+        if anime_data is None:
+            err, anime_data = get_anime_data(client, bucketname, input_file)
+
+            if err is not None:
+                logger.info(f"There was an error with downloading the all_anime data\n{err}")
+                raise ValueError("Unable to continue without anime data")
         
         anime_ids = extract_anime_ids(anime_data)
 
         if testing:
             logger.info(f"Testing with a sample size of {sample} anime IDs")
-            # Collect the sample size from the anime_ids generator
-            anime_ids = [id for n, id in enumerate(anime_ids) if n < sample]
-        # Get the anime stats
+            # Stop reading the anime_ids generator once the sample is collected
+            anime_ids = itertools.islice(anime_ids, sample)
+        # Get the anime stats and upload them as they arrive
         logger.info("Extracting anime stats from Jikkan API...")
-        anime_stats = asyncio.run(get_anime_stats(anime_ids))
-        logger.info(f"Extraction complete! Extracted stats for {len(anime_stats)} anime")
-        # Upload the stats
-        logger.info("Uploading to storage...")
-        storage.write_to_storage(
-            client=client, 
-            obj=anime_stats, 
-            prefix=prefix, 
-            filename=output_file, 
-            partition_date=partition_date
-        )
-
-        return (None, len(anime_stats))
+        key = storage.partition_key(prefix, output_file, partition_date)
+        with storage.MultipartWriter(
+            client,
+            bucketname,
+            key,
+            ContentEncoding="gzip",
+            ContentType="application/x-ndjson",
+        ) as writer:
+            # Rows are written from a separate thread, so compressing them and
+            # uploading each part never blocks the event loop fetching stats
+            rows = SimpleQueue()
+
+            def drain():
+                for row in iter(rows.get, None):
+                    writer.write(row)
+
+            def store(row):
+                # A failed writer thread stops the fetch workers straight away,
+                # rather than leaving every remaining stat queued in memory
+                if drained.done():
+                    drained.result()
+                rows.put(row)
+
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                drained = executor.submit(drain)
+                try:
+                    _, failed = asyncio.run(get_anime_stats(anime_ids, store=store))
+                finally:
+                    rows.put(None)
+                drained.result()
+        if failed:
+            logger.info(f"Gave up on stats for {len(failed)} rate limited anime")
+        logger.info(f"Extraction complete! Uploaded stats for {writer.rows} anime to {key}")
+
+        return (None, writer.rows)
 
     except Exception as ex:
         return (ex, 0)
@@ -172,11 +294,11 @@ def main() -> None:
 
     Command Example: 
 
-    File endpoint (w/ bucket name): myanimelist/all_anime/raw/year=2022/month=10/day=11/all_anime.json
+    File endpoint (w/ bucket name): myanimelist/all_anime/raw/year=2022/month=10/day=11/all_anime.ndjson.gz
     
     Command:
     ```
-    python animestats.py all_anime/raw/year=2022/month=10/day=11/all_anime.json
+    python animestats.py all_anime/raw/year=2022/month=10/day=11/all_anime.ndjson.gz
     ```
 
     """
@@ -187,25 +309,12 @@ def main() -> None:
     config = dotenv_values(config_path.resolve())
     commands = sys.argv[1:]
     input_file = commands[0]
-    command_str = " ".join(commands)
-    testing = False
-    sample = 0
-    if len(commands) == 4:
-        tests = [
-            commands[1] == "sample",
-            commands[2] == "-n",
-            commands[3].isnumeric(),
-        ]
-        valid_cmd = all(tests)
-        if not valid_cmd:
-            logger.info(
-                f"{command_str} was an invalid command."
-                "Continuing with default settings..."
-            )
-        else:
-            testing = True
-            sample = int(commands[3])
-            logger.info(f"Test run starting... collecting stats for {sample} anime")
+    sample = command_validator(commands[1:])
+    testing = sample is not None
+    if testing:
+        logger.info(f"Test run starting... collecting stats for {sample} anime")
+    else:
+        sample = 0
 
     logger.info("Starting process...")
     # Connect to client
@@ -222,7 +331,7 @@ def main() -> None:
     duration = round(end - start, 2)
     if err is not None:
         logger.info(f"An error occurred while getting anime stats.\n{repr(err)}")
-        os._exit(1)
+        sys.exit(1)
     logger.info(f"Uploaded {status} anime! Elapsed time: {duration} second(s)")
 
 
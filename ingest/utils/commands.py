@@ -0,0 +1,32 @@
+"""A helper for parsing the commandline arguments shared by the ingest scripts"""
+from loguru import logger
+
+
+def command_validator(commands: list) -> int:
+    """
+    Takes in a list of commands from stdin and
+    determines whether or not to perform a test
+    run. Returns the sample size given with
+    `sample -n <size>`, or `None` for a full run.
+
+    :param commands: A list of commands from stdinput
+    """
+    sample = None
+    command_str = " ".join(commands)
+    # Handle trial runs
+    if len(commands) == 3:
+        tests = [
+            commands[0] == "sample",
+            commands[1] == "-n",
+            commands[2].isnumeric(),
+        ]
+        valid_cmd = all(tests)
+        if not valid_cmd:
+            logger.info(
+                f"{command_str} was an invalid command."
+                "Continuing with default settings..."
+            )
+        else:
+            sample = int(commands[2])
+
+    return sample
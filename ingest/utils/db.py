@@ -1,4 +1,5 @@
 """A collection of functions for writing data to the database"""
+import orjson
 import psycopg2
 from loguru import logger
 from sqlalchemy import text
@@ -9,6 +10,24 @@ from psycopg2.errors import (
     ProgrammingError,
 )
 
+# Built once at import rather than on every call to ingest.
+# The whole batch is bound as one JSON array and unpacked by the server.
+INSERT_ANIME = text(
+    """
+    INSERT INTO anime_stage.all_anime
+    (id,title,status,airing,rating,score,
+    favorites,aired_from,aired_to,load_date)
+    SELECT
+    mal_id,title,status,airing,rating,score,
+    favorites,aired_from,aired_to,NOW()
+    FROM jsonb_to_recordset(CAST(:payload AS jsonb)) AS anime(
+        mal_id bigint, title text, status text, airing boolean,
+        rating text, score float, favorites int,
+        aired_from text, aired_to text
+    )
+    """
+)
+
 
 async def ingest(data, engine) -> None:
     """ "
@@ -20,15 +39,8 @@ async def ingest(data, engine) -> None:
         async with engine.begin() as conn:
 
             try:
-                query = """
-                    INSERT INTO anime_stage.all_anime
-                    (id,title,status,airing,rating,score,
-                    favorites,aired_from,aired_to,load_date)
-                    VALUES
-                    (:mal_id,:title,:status,:airing,:rating,:score,
-                    :favorites,:aired_from,:aired_to,NOW())
-                """
-                await conn.execute(text(query), parameters=data)
+                payload = orjson.dumps(data).decode()
+                await conn.execute(INSERT_ANIME, parameters={"payload": payload})
             except (TypeError, OperationalError, InterfaceError):
                 logger.exception("Error occurred during query...")
 
@@ -49,23 +61,25 @@ def clear_staging(connection: psycopg2.connect):
             """
             )
     except Exception as err:
-        print(f"Exception occurred while connecting to the database: {err}")
+        logger.exception("Exception occurred while connecting to the database: {}", err)
         raise
 
 
 def refresh_views(connection: psycopg2.connect):
     """
-    Refreshes materialized views
+    Refreshes materialized views. The refresh is done concurrently
+    so that readers are not blocked while the view is rebuilt.
     """
     try:
         with connection.cursor() as cursor:
             cursor.execute(
                 """
-                REFRESH MATERIALIZED VIEW anime.anime_stats_and_scores;
+                SET LOCAL max_parallel_workers_per_gather = 4;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY anime.anime_stats_and_scores;
             """
             )
     except Exception as err:
-        print(f"Exception occurred while connecting to the database: {err}")
+        logger.exception("Exception occurred while connecting to the database: {}", err)
         raise
 
 
@@ -83,5 +97,5 @@ def insert_anime_scores_and_stats(connection: psycopg2.connect):
             """
             )
     except Exception as err:
-        print(f"Exception occurred while connecting to the database: {err}")
+        logger.exception("Exception occurred while connecting to the database: {}", err)
         raise
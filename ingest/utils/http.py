@@ -0,0 +1,73 @@
+"""A helper for creating HTTP sessions to the Jikkan API"""
+import aiohttp
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+
+
+def create_session(
+    limit: int = 3,
+    cache_name: str = "jikan_cache",
+    expire_after: int = 3600,
+) -> aiohttp.ClientSession:
+    """
+    Returns a client session with a connection pool tuned for the Jikkan API.
+    Connections are kept alive between requests and DNS lookups are cached,
+    so the TLS handshake is paid once per pooled connection rather than on
+    every request. Responses are requested gzip encoded and decompressed
+    transparently by aiohttp, and hung sockets are bounded by a timeout.
+
+    Successful responses are cached on disk in a SQLite database, so re-runs
+    and retries after a failure skip the endpoints that were already fetched.
+
+    :param limit: The maximum number of simultaneous connections to the API
+    :param cache_name: The name of the response cache. Pass `None` to disable it.
+    :param expire_after: The number of seconds that a cached response stays valid
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        keepalive_timeout=60,
+        ttl_dns_cache=600,
+    )
+    timeout = aiohttp.ClientTimeout(total=30, connect=5)
+    headers = {
+        "Accept-Encoding": "gzip, deflate",
+        "User-Agent": "myanimelist-data-pipeline",
+    }
+    if cache_name is None:
+        return aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers=headers
+        )
+    return CachedSession(
+        cache=SQLiteBackend(cache_name, expire_after=expire_after),
+        connector=connector,
+        timeout=timeout,
+        headers=headers,
+    )
+
+
+async def is_cached(session: aiohttp.ClientSession, url: str) -> bool:
+    """
+    Returns `True` if the session's cache holds a fresh response for a GET
+    of `url`. Cached requests never reach the API, so callers can skip the
+    rate limiter for them and a re-run over a warm cache is not paced.
+
+    :param session: A session created by `create_session`
+    :param url: The URL that is about to be requested
+    """
+    cache = getattr(session, "cache", None)
+    if cache is None:
+        return False
+    # get_response drops expired entries, so a stale response is not counted
+    return await cache.get_response(cache.create_key("GET", url)) is not None
+
+
+async def discard(response: aiohttp.ClientResponse) -> None:
+    """
+    Reads and throws away the body of an unwanted response, then hands its
+    connection back to the pool. A connection whose body was never read
+    cannot be reused, so skipping this would close the connection and the
+    next request would have to open a new one.
+
+    :param response: The response to discard
+    """
+    await response.read()
+    response.release()
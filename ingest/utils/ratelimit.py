@@ -0,0 +1,119 @@
+"""A rate limiter used to pace requests to the Jikkan API"""
+import asyncio
+from collections import deque
+from loguru import logger
+
+
+class RateLimiter():
+    """
+    An asyncio rate limiter that enforces the Jikkan API limits of
+    `per_second` and `per_minute` requests. The timestamps of recent
+    requests are kept in a sliding window for each limit, so requests go
+    out at the full allowed rate and callers only wait once a window is
+    full, and then only until its oldest request expires. A single limiter
+    is meant to be shared by every coroutine calling the API.
+
+    When the API responds with a 429, `backoff` holds every caller back
+    until the server is ready to accept requests again. Callers that
+    report each response to `record` also get an adaptive rate: both
+    limits are scaled down by half while more than 5% of the last minute
+    of responses were rate limited, and scaled back up by a quarter, up to
+    the configured limits, after a minute with less than 1% rate limited.
+    The rate is only lowered once the minute holds at least 20 responses,
+    so a single early 429 is not enough to halve it.
+
+    :param per_second: The maximum number of requests in any one second
+    :param per_minute: The maximum number of requests in any one minute
+    """
+    def __init__(self, per_second: int = 3, per_minute: int = 60):
+        self.ceilings = (per_second, per_minute)
+        self.limits = ((1, per_second), (60, per_minute))
+        self.windows = (deque(), deque())
+        self.resume_at = 0
+        self.lock = asyncio.Lock()
+        self.outcomes = deque()
+        self.scale = 1
+        self.adjusted_at = 0
+
+
+    def _set_scale(self, scale: float, now: float) -> None:
+        # Both limits are scaled, since either one can be the one capping the rate
+        per_second, per_minute = (max(1, int(ceiling * scale)) for ceiling in self.ceilings)
+        logger.info(
+            f"Adjusting the request rate to {per_second} per second and {per_minute} per minute"
+        )
+        self.scale = scale
+        self.limits = ((1, per_second), (60, per_minute))
+        self.adjusted_at = now
+
+
+    def _wait_time(self, now: float) -> float:
+        wait = self.resume_at - now
+        for (period, limit), window in zip(self.limits, self.windows):
+            # Drop the requests that have left this window
+            while window and now - window[0] >= period:
+                window.popleft()
+            if len(window) >= limit:
+                wait = max(wait, window[0] + period - now)
+        return wait
+
+
+    async def acquire(self) -> None:
+        """
+        Waits until a request can be sent without exceeding either limit
+        """
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            wait = self._wait_time(loop.time())
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._wait_time(loop.time())
+            now = loop.time()
+            for window in self.windows:
+                window.append(now)
+
+
+    def backoff(self, delay: float) -> None:
+        """
+        Holds back every caller for at least `delay` seconds
+
+        :param delay: The number of seconds to wait before the next request
+        """
+        loop = asyncio.get_running_loop()
+        self.resume_at = max(self.resume_at, loop.time() + delay)
+
+
+    def record(self, limited: bool) -> None:
+        """
+        Records the outcome of a request and scales both limits to the
+        share of recent requests that were rate limited
+
+        :param limited: Whether the response was rate limited (429)
+        """
+        now = asyncio.get_running_loop().time()
+        self.outcomes.append((now, limited))
+        while now - self.outcomes[0][0] >= 60:
+            self.outcomes.popleft()
+        ratio = sum(limited for _, limited in self.outcomes) / len(self.outcomes)
+        # Give each adjustment a full window to take effect before the next
+        since = now - self.adjusted_at
+        if since < 60:
+            return
+        if ratio > 0.05 and len(self.outcomes) >= 20 and self.scale > 1 / 16:
+            self._set_scale(self.scale / 2, now)
+        elif ratio < 0.01 and self.scale < 1:
+            self._set_scale(min(1, self.scale * 1.25), now)
+
+
+def retry_after(headers, default: float = 0) -> float:
+    """
+    Returns the number of seconds to wait given by a `Retry-After` header,
+    or `default` if the header is missing or not a number of seconds.
+
+    :param headers: The headers of a rate limited response
+    :param default: The number of seconds to use without a valid header
+    """
+    try:
+        return float(headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        return default
@@ -1,11 +1,67 @@
 """A class that handles writing data to storage"""
+import gzip
+import zlib
 import boto3
-import json
+import base64
+import hashlib
+import orjson
 from io import BytesIO
 from loguru import logger
 from datetime import datetime
+from functools import lru_cache
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
 
+# Objects above the threshold are uploaded in parts by parallel threads
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+# Enough pooled connections for the threaded uploads to run in parallel
+# instead of queueing on botocore's default pool of 10
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+
+
+@lru_cache(maxsize=4)
+def _create_client(access_key_id: str, secret_access_key: str, endpoint: str):
+    # Building a client loads the botocore service model, so each client
+    # is built once per set of credentials and shared. boto3 clients are
+    # thread safe.
+    return boto3.client(
+        "s3",
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        endpoint_url=endpoint,
+        config=CLIENT_CONFIG,
+    )
+
+
+@lru_cache(maxsize=64)
+def _partition_prefix(prefix: str, year: int, month: int, day: int) -> str:
+    return f"{prefix}/year={year}/month={month}/day={day}"
+
+
+def partition_key(prefix: str, filename: str, partition_date: datetime = None) -> str:
+    """
+    Returns the key of a file in the date partition of the given prefix.
+    The partition prefix is built once per day and prefix and reused.
+
+    :param prefix: The root prefix of the data set
+    :param filename: The filename of the object for use in the bucket
+    :param partition_date: The partition date. Defaults to now.
+    """
+    dt = partition_date or datetime.now()
+    return f"{_partition_prefix(prefix, dt.year, dt.month, dt.day)}/{filename}"
+
 
 def access_storage(config: dict):
     """
@@ -15,11 +71,8 @@ def access_storage(config: dict):
     """
     endpoint = config.get("ENDPOINT_URL")
     try:
-        client = boto3.client(
-            "s3",
-            aws_access_key_id=config["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=config["AWS_SECRET_ACCESS_KEY"],
-            endpoint_url=endpoint,
+        client = _create_client(
+            config["AWS_ACCESS_KEY_ID"], config["AWS_SECRET_ACCESS_KEY"], endpoint
         )
         
     except ClientError:
@@ -32,13 +85,46 @@ def access_storage(config: dict):
     
     return client
 
+def upload_bytes(
+    client: boto3.client, body: bytes, bucketname: str, key: str, **extra_args
+) -> None:
+    """
+    Uploads the given bytes to storage. Large bodies are sent as a
+    multipart upload with the parts uploaded in parallel. Smaller bodies
+    are sent in a single PUT along with their MD5, so S3 rejects a
+    corrupted upload instead of storing it.
+
+    :param client: A boto3 client configured to write to s3
+    :param body: The serialized object to upload
+    :param bucketname: The name of the storage bucket
+    :param key: The key to write the object to
+    :param extra_args: Extra arguments for the upload, such as `ContentType`
+    """
+    if len(body) < TRANSFER_CONFIG.multipart_threshold:
+        client.put_object(
+            Body=body,
+            Bucket=bucketname,
+            Key=key,
+            ContentMD5=base64.b64encode(hashlib.md5(body).digest()).decode(),
+            **extra_args,
+        )
+        return
+    client.upload_fileobj(
+        BytesIO(body),
+        bucketname,
+        key,
+        ExtraArgs=extra_args or None,
+        Config=TRANSFER_CONFIG,
+    )
+
+
 def write_to_storage(
     client: boto3.client,
     obj: dict,
     prefix: str,
     filename: str,
     bucketname: str = "myanimelist",
-    partition_date: datetime = datetime.now()
+    partition_date: datetime = None
 ):
     """
     Writes the given object to storage using the provided configuration.
@@ -49,14 +135,58 @@ def write_to_storage(
     :param prefix: The root prefix to write in
     :param filename: The filename of the object for use in the bucket
     :param bucketname: The name of the storage bucket
-    :param partition_date: The partition date to write 
+    :param partition_date: The partition date to write. Defaults to now.
+    """
+    key = partition_key(prefix, filename, partition_date)
+    logger.info("Writing to storage...")
+    try:
+        # orjson returns bytes, which is what the request body needs anyway
+        upload_bytes(
+            client, orjson.dumps(obj), bucketname, key, ContentType="application/json"
+        )
+        logger.info(f"{filename} has been successfully written to storage at {key}")
+    except (ClientError, KeyError):
+        logger.exception("Error occurred while writing to storage...")
+        raise
+
+    return key
+
+
+def write_ndjson_to_storage(
+    client: boto3.client,
+    rows: list,
+    prefix: str,
+    filename: str,
+    bucketname: str = "myanimelist",
+    partition_date: datetime = None,
+    compresslevel: int = 3,
+):
+    """
+    Writes the given rows to storage as gzip compressed NDJSON, with one
+    JSON object per line. Returns the path that the rows were written to.
+
+    :param client: A boto3 client configured to write to s3
+    :param rows: The list of raw dict objects to write to storage
+    :param prefix: The root prefix to write in
+    :param filename: The filename of the object for use in the bucket
+    :param bucketname: The name of the storage bucket
+    :param partition_date: The partition date to write. Defaults to now.
+    :param compresslevel: The gzip compression level. Kept low so that the
+                          cost of compressing stays close to the network cost.
     """
-    dt = partition_date
-    partition_path_date = f"year={dt.year}/month={dt.month}/day={dt.day}"
-    key = f"{prefix}/{partition_path_date}/{filename}"
+    key = partition_key(prefix, filename, partition_date)
     logger.info("Writing to storage...")
     try:
-        client.put_object(Body=json.dumps(obj), Bucket=bucketname, Key=key)
+        with MultipartWriter(
+            client,
+            bucketname,
+            key,
+            compresslevel=compresslevel,
+            ContentEncoding="gzip",
+            ContentType="application/x-ndjson",
+        ) as writer:
+            for row in rows:
+                writer.write(row)
         logger.info(f"{filename} has been successfully written to storage at {key}")
     except (ClientError, KeyError):
         logger.exception("Error occurred while writing to storage...")
@@ -67,27 +197,216 @@ def write_to_storage(
 
 def read_from_storage(client: boto3.client, bucketname: str, filepath: str) -> list:
     """
-    Reads from s3 storage and returns the file found at the given path
+    Reads from s3 storage and returns the file found at the given path.
+    Files ending in `.ndjson.gz` are read as gzip compressed NDJSON and
+    returned as a list with one entry per line.
 
     :param client: An s3 client configured to connect to storage
     :param bucketname: The name of the storage bucket to read from
     :param filepath: The path to the file that you want to read from inside the bucket
     """
-    file_holder = BytesIO()
     try:
-        client.download_fileobj(bucketname, filepath, file_holder)
+        # The body is read in one allocation sized from its Content-Length
+        data = client.get_object(Bucket=bucketname, Key=filepath)["Body"].read()
     except (ClientError, KeyError):
         logger.exception(
             f"Error occurred while reading from storage at filepath: {filepath}"
         )
         raise
 
-    file_holder.seek(0)
-    result = json.load(file_holder)
+    if filepath.endswith(".ndjson.gz"):
+        lines = gzip.decompress(data).splitlines()
+        return [orjson.loads(line) for line in lines if line]
+
+    result = orjson.loads(data)
 
     return result
 
 
+def stream_from_storage(
+    client: boto3.client, bucketname: str, filepath: str, chunksize: int = 1024 * 1024
+):
+    """
+    Reads a gzip compressed NDJSON file from s3 storage and returns an
+    iterator over its rows. The object is decompressed and parsed as it
+    is downloaded, so only one row is held in memory at a time instead
+    of the whole file. The body is read in `chunksize` pieces, since the
+    8 KiB reads that `gzip.GzipFile` makes leave the download bound on
+    Python overhead rather than on the network.
+
+    :param client: An s3 client configured to connect to storage
+    :param bucketname: The name of the storage bucket to read from
+    :param filepath: The path to the `.ndjson.gz` file inside the bucket
+    :param chunksize: The number of compressed bytes read from the body at a time
+    """
+    try:
+        body = client.get_object(Bucket=bucketname, Key=filepath)["Body"]
+    except (ClientError, KeyError):
+        logger.exception(
+            f"Error occurred while reading from storage at filepath: {filepath}"
+        )
+        raise
+
+    def rows():
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        pending = b""
+        for chunk in body.iter_chunks(chunk_size=chunksize):
+            while chunk:
+                pending += decompressor.decompress(chunk)
+                chunk = decompressor.unused_data
+                if decompressor.eof:
+                    # Another gzip member follows the one that just ended
+                    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            *lines, pending = pending.split(b"\n")
+            yield from (orjson.loads(line) for line in lines if line.strip())
+        if pending.strip():
+            yield orjson.loads(pending)
+
+    return rows()
+
+
+class MultipartWriter():
+    """
+    Streams rows to storage as gzip compressed NDJSON. Compressed output
+    is uploaded as a part of a multipart upload each time `part_size`
+    bytes have built up, so only a few parts are held in memory instead
+    of the whole serialized object. Parts are uploaded by a small pool of
+    threads, so compressing the next part overlaps with uploading the
+    last ones. Output that never fills a part is sent as a single PUT
+    instead. The number of rows written so far is kept in `rows`.
+
+    :param client: A boto3 client configured to write to s3
+    :param bucketname: The name of the storage bucket
+    :param key: The key to write the object to
+    :param part_size: The size of each uploaded part. Must be at least 5 MiB.
+    :param compresslevel: The gzip compression level
+    :param max_concurrency: The maximum number of parts uploaded at the same time
+    :param extra_args: Extra arguments for the upload, such as `ContentType`
+    """
+    def __init__(
+        self,
+        client: boto3.client,
+        bucketname: str,
+        key: str,
+        part_size: int = 8 * 1024 * 1024,
+        compresslevel: int = 3,
+        max_concurrency: int = 4,
+        **extra_args,
+    ):
+        self.client = client
+        self.bucketname = bucketname
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args
+        self.upload_id = None
+        self.parts = []
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.rows = 0
+        self.buffer = BytesIO()
+        self.gz = gzip.GzipFile(
+            fileobj=self.buffer, mode="wb", compresslevel=compresslevel
+        )
+
+
+    def _upload_part(self) -> None:
+        if self.upload_id is None:
+            upload = self.client.create_multipart_upload(
+                Bucket=self.bucketname, Key=self.key, **self.extra_args
+            )
+            self.upload_id = upload["UploadId"]
+        # Wait for the oldest upload once the pool is full, so that only
+        # `max_concurrency` parts are ever held in memory
+        if len(self.parts) >= self.max_concurrency:
+            self.parts[-self.max_concurrency].result()
+        number = len(self.parts) + 1
+        self.parts.append(
+            self.executor.submit(self._send_part, number, self.buffer.getvalue())
+        )
+        # The gzip stream only ever appends, so the buffer can be reused
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+    def _send_part(self, number: int, body: bytes) -> dict:
+        part = self.client.upload_part(
+            Body=body,
+            Bucket=self.bucketname,
+            Key=self.key,
+            PartNumber=number,
+            UploadId=self.upload_id,
+        )
+        return {"ETag": part["ETag"], "PartNumber": number}
+
+
+    def write(self, row: dict) -> None:
+        """
+        Writes a single row as a line of JSON
+
+        :param row: The raw dict object to write
+        """
+        self.gz.write(orjson.dumps(row))
+        self.gz.write(b"\n")
+        self.rows += 1
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+
+    def close(self) -> None:
+        """
+        Flushes the remaining output and completes the upload
+        """
+        self.gz.close()
+        if self.upload_id is None:
+            self.executor.shutdown()
+            upload_bytes(
+                self.client,
+                self.buffer.getvalue(),
+                self.bucketname,
+                self.key,
+                **self.extra_args,
+            )
+            return
+        if self.buffer.tell() > 0:
+            self._upload_part()
+        parts = [part.result() for part in self.parts]
+        self.executor.shutdown()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucketname,
+            Key=self.key,
+            MultipartUpload={"Parts": parts},
+            UploadId=self.upload_id,
+        )
+
+
+    def abort(self) -> None:
+        """
+        Cancels the upload, discarding any parts uploaded so far
+        """
+        self.gz.close()
+        # Let the parts in flight finish so none are left behind the abort
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucketname, Key=self.key, UploadId=self.upload_id
+            )
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
+
+
 class Writer():
     """
     A class used to read from and write to s3 storage. It is
@@ -97,17 +416,19 @@ class Writer():
     :param AWS_ACCESS_KEY_ID: The AWS Access Key ID for the client
     :param AWS_SECRET_ACCESS_KEY: The AWS Secret Access Key for the client
     :param ENDPOINT_URL (optional): The endpoint URL for the storage location 
+
+    Objects are written as plain JSON by default. Pass a `compresslevel`
+    to gzip them instead, in which case `.gz` is added to their filenames.
     """
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, compresslevel: int = None):
         
         def _init_client(config: dict):
             endpoint = config.get("ENDPOINT_URL")
             try:
-                client = boto3.client(
-                    "s3",
-                    aws_access_key_id=config["AWS_ACCESS_KEY_ID"],
-                    aws_secret_access_key=config["AWS_SECRET_ACCESS_KEY"],
-                    endpoint_url=endpoint,
+                client = _create_client(
+                    config["AWS_ACCESS_KEY_ID"],
+                    config["AWS_SECRET_ACCESS_KEY"],
+                    endpoint,
                 )
             except ClientError:
                 logger.exception("Client received invalid credentials")
@@ -118,6 +439,23 @@ class Writer():
         
         self.config = config
         self.client = _init_client(self.config)
+        self.compresslevel = compresslevel
+
+
+    def _upload(
+        self, obj: dict, partition: str, filename: str, date: datetime, bucket: str
+    ) -> str:
+        # Returns the key that the object was written to
+        body = orjson.dumps(obj)
+        extra_args = {"ContentType": "application/json"}
+        if self.compresslevel is not None:
+            body = gzip.compress(body, compresslevel=self.compresslevel)
+            if not filename.endswith(".gz"):
+                filename = f"{filename}.gz"
+            extra_args["ContentEncoding"] = "gzip"
+        key = partition_key(partition, filename, date)
+        upload_bytes(self.client, body, bucket, key, **extra_args)
+        return key
 
 
     def write_to_storage(
@@ -125,49 +463,86 @@ class Writer():
         obj: dict,
         partition: str,
         filename: str,
-        date: datetime = datetime.now(),
+        date: datetime = None,
         bucket: str = "myanimelist",
-    ):
+    ) -> str:
         """
         Writes the given object to storage using the provided configuration.
+        Returns the key that the object was written to.
 
         :param obj: The raw dict object to write to storage
         :param partition: The primary storage partition for the file
         :param filename: The filename of the object for use in the bucket
-        :param date: A datetime used for creating the partition path
+        :param date: A datetime used for creating the partition path. Defaults to now.
         :param bucket: The name of the storage bucket
         """
-        dt = date
-        partition_date = f"year={dt.year}/month={dt.month}/day={dt.day}"
-        key = f"{partition}/{partition_date}/{filename}"
         logger.info("Writing to storage...")
         try:
-            self.client.put_object(Body=json.dumps(obj), Bucket=bucket, Key=key)
+            key = self._upload(obj, partition, filename, date, bucket)
             logger.info(f"{filename} has been successfully written to storage at {key}")
         except (ClientError, KeyError):
             logger.exception("Error occurred while writing to storage...")
             raise
-    
+
+        return key
+
+
+    def write_many(
+        self,
+        items: list,
+        date: datetime = None,
+        bucket: str = "myanimelist",
+        max_workers: int = 16,
+    ) -> list:
+        """
+        Writes many objects to storage at once. Each PUT spends most of its
+        time waiting on the network, so the uploads are spread over a pool
+        of threads sharing this client. Returns the keys that were written.
+
+        :param items: A list of (obj, partition, filename) tuples to write
+        :param date: A datetime used for creating the partition paths. Defaults to now.
+        :param bucket: The name of the storage bucket
+        :param max_workers: The number of uploads to run at the same time
+        """
+        date = date or datetime.now()
+        logger.info(f"Writing {len(items)} objects to storage...")
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                uploads = [
+                    executor.submit(self._upload, obj, partition, filename, date, bucket)
+                    for obj, partition, filename in items
+                ]
+                for upload in as_completed(uploads):
+                    upload.result()
+            keys = [upload.result() for upload in uploads]
+            logger.info(f"{len(keys)} objects have been successfully written to storage")
+        except (ClientError, KeyError):
+            logger.exception("Error occurred while writing to storage...")
+            raise
+
+        return keys
+
 
     def read_from_storage(self, bucketname: str, filepath: str) -> list:
         """
-        Reads from s3 storage and returns the file found at the given path
+        Reads from s3 storage and returns the file found at the given path.
+        Files ending in `.gz` are decompressed first.
 
         :param bucketname: The name of the storage bucket to read from
         :param filepath: The path to the file that you want to read from inside the bucket
         """
-        file_holder = BytesIO()
-
         try:
-            self.client.download_fileobj(bucketname, filepath, file_holder)
+            response = self.client.get_object(Bucket=bucketname, Key=filepath)
+            data = response["Body"].read()
         except (ClientError, KeyError):
             logger.exception(
                 f"Error occurred while reading from storage at filepath: {filepath}"
             )
             raise
 
-        file_holder.seek(0)
-        result = json.load(file_holder)
+        if filepath.endswith(".gz"):
+            data = gzip.decompress(data)
+        result = orjson.loads(data)
 
         return result
 
@@ -4,66 +4,180 @@ for storage in the data lake
 """
 from pyspark.sql import SparkSession
 import boto3
-import json
+import gzip
+import orjson
 import time
 import os
-from io import BytesIO
+import pandas as pd
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pyspark.sql import DataFrame as SparkDataFrame
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import pyspark.sql.functions as F
-from flatdict import FlatDict
+from pyspark.sql.types import (
+    StructType, StructField, LongType, DoubleType, StringType, BooleanType
+)
 from loguru import logger
 
+# The shape of the Jikkan endpoints is fixed, so the schemas are given up
+# front instead of being inferred from the data on every run
+ALL_ANIME_SCHEMA = StructType([
+    StructField('mal_id', LongType()),
+    StructField('title', StringType()),
+    StructField('status', StringType()),
+    StructField('rating', StringType()),
+    StructField('score', DoubleType()),
+    StructField('favorites', LongType()),
+    StructField('airing', BooleanType()),
+    StructField('aired_from', StringType()),
+    StructField('aired_to', StringType()),
+])
+
+ANIME_STATS_SCHEMA = StructType([
+    StructField('watching', LongType()),
+    StructField('completed', LongType()),
+    StructField('on_hold', LongType()),
+    StructField('dropped', LongType()),
+    StructField('plan_to_watch', LongType()),
+    StructField('total', LongType()),
+    StructField('mal_id', LongType()),
+    StructField('update_time', LongType()),
+])
+
+ANIME_SCORES_SCHEMA = StructType([
+    StructField('score', LongType()),
+    StructField('votes', LongType()),
+    StructField('percentage', DoubleType()),
+    StructField('mal_id', LongType()),
+    StructField('update_time', LongType()),
+])
+
+# The number of byte ranges that read_object downloads at the same time
+READ_WORKERS = 12
+
+
+def read_object(
+    client: boto3.client,
+    bucketname: str,
+    filepath: str,
+    chunksize: int = 16 * 1024 * 1024,
+    max_workers: int = READ_WORKERS,
+) -> bytearray:
+    """
+    Downloads an object from s3 storage with parallel byte-range GETs.
+    The first range also reports the size of the object, so objects that
+    fit in one chunk are still downloaded with a single request. Each
+    range is written into one preallocated buffer at its offset.
+
+    :param client: An s3 client configured to connect to storage
+    :param bucketname: The name of the storage bucket to read from
+    :param filepath: The path to the file that you want to read from inside the bucket
+    :param chunksize: The size of each byte range
+    :param max_workers: The number of ranges to download at the same time
+    """
+    def get_range(start: int) -> dict:
+        return client.get_object(
+            Bucket=bucketname, Key=filepath, Range=f'bytes={start}-{start + chunksize - 1}'
+        )
+
+    def fetch(start: int, response: dict = None) -> None:
+        body = (response or get_range(start))['Body'].read()
+        data[start:start + len(body)] = body
+
+    first = get_range(0)
+    # ContentRange looks like `bytes 0-16777215/123456789`
+    data = bytearray(int(first['ContentRange'].rsplit('/', 1)[1]))
+    size = len(data)
+    fetch(0, first)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fetch, range(chunksize, size, chunksize)))
+    return data
+
+
 def read_from_storage(client: boto3.client, bucketname: str, filepath: str) -> list:
     """
-    Reads from s3 storage and returns the file found at the given path
+    Reads from s3 storage and returns the file found at the given path.
+    Files ending in `.ndjson.gz` are read as gzip compressed NDJSON and
+    returned as a list with one entry per line.
 
     :param client: An s3 client configured to connect to storage
     :param bucketname: The name of the storage bucket to read from
     :param filepath: The path to the file that you want to read from inside the bucket
     """
-    file_holder = BytesIO()
     try:
-        client.download_fileobj(bucketname, filepath, file_holder)
+        data = read_object(client, bucketname, filepath)
     except (ClientError, KeyError):
         logger.exception(
             f"Error occurred while reading from storage at filepath: {filepath}"
         )
         raise
 
-    file_holder.seek(0)
-    result = json.load(file_holder)
+    if filepath.endswith('.ndjson.gz'):
+        lines = gzip.decompress(data).splitlines()
+        return [orjson.loads(line) for line in lines if line]
+
+    result = orjson.loads(data)
 
     return result
 
 
-def flatten_stats(anime_stats: dict) -> dict:
+def conform_to_schema(frame: pd.DataFrame, schema: StructType) -> pd.DataFrame:
+    """
+    Puts the columns of a flattened frame in schema order and casts
+    them to the schema types. pandas holds any missing fields as NaN
+    floats, so long columns with gaps are rebuilt as object columns of
+    Python ints and None, which Spark loads as nulls on both the Arrow
+    and the non-Arrow path.
+
+    :param frame: The flattened data
+    :param schema: The schema that the data will be loaded with
+    """
+    # Spark matches the columns to the schema by position
+    frame = frame.reindex(columns=schema.fieldNames())
+    for field in schema.fields:
+        column = frame[field.name]
+        if not isinstance(field.dataType, LongType):
+            frame[field.name] = column.astype('float64')
+        elif column.isna().any():
+            # A plain list would be inferred as float64 with NaN again
+            frame[field.name] = pd.Series(
+                [None if pd.isna(value) else int(value) for value in column],
+                index=frame.index,
+                dtype=object,
+            )
+        else:
+            frame[field.name] = column.astype('int64')
+    return frame
+
+
+def flatten_stats(raw_anime_stats: list, update_time: int) -> pd.DataFrame:
     """
     Flattens the anime statistics section of the raw
-    anime_stats data
+    anime_stats data into one row per anime
 
-    :param anime_stats: A collection of stats and scores for an anime
+    :param raw_anime_stats: A list of the stats and scores for each anime
+    :param update_time: The time of this run in milliseconds, stamped on every row
     """
-    flat = dict(FlatDict(anime_stats['data'], delimiter='_'))
-    flat['mal_id'] = anime_stats['mal_id']
-    flat['update_time'] = int(time.time() * 1000)
-    return json.dumps(flat)
+    stats = pd.json_normalize([anime['data'] for anime in raw_anime_stats], sep='_')
+    stats['mal_id'] = [anime['mal_id'] for anime in raw_anime_stats]
+    stats['update_time'] = update_time
+    return conform_to_schema(stats, ANIME_STATS_SCHEMA)
 
 
-def extract_and_flatten_scores(anime_stats: dict) -> dict:
+def extract_and_flatten_scores(raw_anime_stats: list, update_time: int) -> pd.DataFrame:
     """
     Extracts and flattens the anime scores section of the raw
-    anime_stats data
+    anime_stats data into one row per score of each anime
 
-    :param anime_stats: A collection of stats and scores for an anime
+    :param raw_anime_stats: A list of the stats and scores for each anime
+    :param update_time: The time of this run in milliseconds, stamped on every row
     """
-    scores = []
-    for score in anime_stats['data']['scores']:
-        score['mal_id'] = anime_stats['mal_id']
-        score['update_time'] = int(time.time() * 1000)
-        scores.append(score)
-    return scores
+    scores = pd.json_normalize(
+        raw_anime_stats, record_path=['data', 'scores'], meta=['mal_id']
+    )
+    scores['update_time'] = update_time
+    return conform_to_schema(scores, ANIME_SCORES_SCHEMA)
 
 
 def write_to_hudi(
@@ -112,6 +226,7 @@ def get_spark_session_and_context(appname: str):
         .appName(appname)
         .config('spark.jars', '/opt/bitnami/spark/jars/hudi-spark3.2-bundle_2.12-0.12.0.jar')
         .config('spark.serializer', 'org.apache.spark.serializer.KryoSerializer')
+        .config('spark.sql.execution.arrow.pyspark.enabled', 'true')
         .config('spark.sql.catalog.spark_catalog', 'org.apache.spark.sql.hudi.catalog.HoodieCatalog')
         .config('spark.sql.extensions', 'org.apache.spark.sql.hudi.HoodieSparkSessionExtension')
         .config('spark.hadoop.fs.s3a.connection.ssl.enabled', 'false')
@@ -132,30 +247,40 @@ def main():
     spark, sc = get_spark_session_and_context('anime_transform')
     today = datetime.now()
     date_partition = f'{today.year}/{today.month}/{today.day}'
+    raw_partition = f'year={today.year}/month={today.month}/day={today.day}'
     # Get client
-    client = boto3.client('s3', endpoint_url=os.environ['ENDPOINT_URL'])
+    # One pooled connection for each of read_object's range downloads
+    client = boto3.client(
+        's3',
+        endpoint_url=os.environ['ENDPOINT_URL'],
+        config=Config(max_pool_connections=READ_WORKERS),
+    )
     # Get anime data
     logger.info('Retrieving data from storage...')
-    raw_anime_data = spark.read.json(
-        f's3a://myanimelist/all_anime/raw/year={today.year}/month={today.month}/day={today.day}/all_anime.json'
+    raw_anime_data = spark.read.schema(ALL_ANIME_SCHEMA).json(
+        f's3a://myanimelist/all_anime/raw/{raw_partition}/all_anime.ndjson.gz'
     )
     # Get anime stats
     raw_anime_stats = read_from_storage(
         client, 
         bucketname='myanimelist', 
-        filepath=f'anime_stats/raw/year={today.year}/month={today.month}/day={today.day}/anime_stats.json')
+        filepath=f'anime_stats/raw/{raw_partition}/anime_stats.ndjson.gz')
     logger.info('Creating Dataframes...')
+    # Stats and scores from the same run share one update time
+    update_time = int(time.time() * 1000)
     # Create all anime
     all_anime = raw_anime_data.withColumn('update_time', F.lit(time.time() * 1000))
     all_anime = all_anime.withColumn('partition_path', F.lit(date_partition))
     # Create anime stats
-    anime_stats = sc.parallelize(raw_anime_stats).map(flatten_stats)
-    anime_stats = spark.read.json(anime_stats)
-    anime_stats = anime_stats.drop('scores')
+    anime_stats = spark.createDataFrame(
+        flatten_stats(raw_anime_stats, update_time), schema=ANIME_STATS_SCHEMA
+    )
     anime_stats = anime_stats.withColumn('partition_path', F.lit(date_partition))
     # Create anime scores
-    anime_scores = sc.parallelize(raw_anime_stats).map(extract_and_flatten_scores).flatMap(lambda x: x)
-    anime_scores = spark.read.option('multiline','true').json(anime_scores)
+    anime_scores = spark.createDataFrame(
+        extract_and_flatten_scores(raw_anime_stats, update_time),
+        schema=ANIME_SCORES_SCHEMA,
+    )
     anime_scores = anime_scores.withColumn('partition_path', F.lit(date_partition))
     logger.info('Writing to storage...')
     # Write to storage